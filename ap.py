@@ -1,16 +1,50 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 import argparse
+import collections
+import io
+import itertools
+import mmap
+import multiprocessing
+import multiprocessing.util
 import os
+import pickle
+import queue
 import chess.pgn
+import chess.polyglot
 import chess.uci
 import sys
 import re
+import threading
 import time
 
 __author__ = "Carlos Alamo"
 __date__ = "2016-03-20"
 __version__ = "0.01"
 
+# Characters that make a name to search a regular expression
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+# Buffer size in bytes of the CSV output file
+CSV_BUFFER_SIZE = 1 << 20
+# Splitting of a pgn file in games, without parsing them
+PGN_INDEX_VERSION = 3
+PGN_GAME_START = b'\n[Event '
+PGN_WHITE_REGEX = re.compile(rb'^\[White "((?:[^"\\]|\\.)*)"\]', re.MULTILINE)
+PGN_BLACK_REGEX = re.compile(rb'^\[Black "((?:[^"\\]|\\.)*)"\]', re.MULTILINE)
+PGN_ENCODING = 'utf-8'
+# Positions prepared in advance while the engine is searching
+POSITIONS_AHEAD = 8
+
+# Engine and analysis settings of a worker process (see _init_worker)
+_WORKER_ENGINE = None
+_WORKER_DEPTHS = None
+_WORKER_PLAYER = None
+
+# Transposition table: (zobrist hash, ply, move) -> (best move, played move)
+TT = collections.OrderedDict()
+TT_SIZE = 1000000
+# Entries added to the TT since the last game sent back by the worker
+_TT_NEW = []
+
 
 class Player:
     """
@@ -37,15 +71,17 @@ class Move:
         self.nodes = 0
         self.time = 0.0
 
-    def fill(self, stats):
+    def fill(self, stats, line=1):
         """
             Fill the move with the data of stats
+        :param stats: InfoHandler with the statistics of the search
+        :param line: Line of the MultiPV search with the move
         """
         self.ply = stats.info.get('depth', None)
-        self.move = stats.info['pv'][1][0]
-        self.mate = stats.info['score'][1][1]
+        self.move = stats.info['pv'][line][0]
+        self.mate = stats.info['score'][line][1]
         if not self.mate:
-            self.cp = float(stats.info['score'][1][0]) / 100
+            self.cp = float(stats.info['score'][line][0]) / 100
         else:
             self.cp = 100.0
         self.nodes = stats.info['nodes']
@@ -57,16 +93,28 @@ class Engine:
         Engine use for the analysis.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, threads=None, hash_mb=None, multi_pv=None):
         """
             Check that the engine executable exists and start it
+        :param path: Path of the engine executable
+        :param threads: Number of search threads of the engine
+        :param hash_mb: Size in MB of the hash table of the engine
+        :param multi_pv: Number of best lines searched by the engine
         """
-        if not os.path.isfile(path):
-            print 'Engine {} does not exists.'.format(path)
-            sys.exit(1)
+        check_engine(path)
         self.engine = chess.uci.popen_engine(path)
         self.engine.uci()
         self.name = self.engine.name
+        options = {}
+        if threads and 'Threads' in self.engine.options:
+            options['Threads'] = threads
+        if hash_mb and 'Hash' in self.engine.options:
+            options['Hash'] = hash_mb
+        if multi_pv and 'MultiPV' in self.engine.options:
+            options['MultiPV'] = multi_pv
+        if options:
+            # setoption waits for the engine to be ready
+            self.engine.setoption(options)
 
     def quit(self):
         """
@@ -75,65 +123,244 @@ class Engine:
         self.engine.quit()
 
 
-def read_all_pgn(filename):
+def default_hash_mb():
+    """
+        Default total hash for the engines: a quarter of the RAM, 4 GB max.
+    :return: Size of the hash in MB
+    """
+    try:
+        ram_mb = (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+                  // (1024 * 1024))
+    except (AttributeError, ValueError, OSError):
+        # No sysconf (Windows)
+        return 1024
+    return max(16, min(ram_mb // 4, 4096))
+
+
+def check_engine(path):
+    """
+        Exit if the engine executable does not exist
+    :param path: [string] Path of the engine executable
+    """
+    if not os.path.isfile(path):
+        print('Engine {} does not exists.'.format(path))
+        sys.exit(1)
+
+
+def tt_get(key):
+    """
+        Get a position already analyzed from the transposition table.
+    :param key: (zobrist hash, ply, move) of the position
+    :return: (best move, played move) or None if it is not in the table
+    """
+    entry = TT.pop(key, None)
+    if entry is not None:
+        # Most recently used goes to the end
+        TT[key] = entry
+    return entry
+
+
+def tt_put(key, entry):
+    """
+        Store a position analyzed by this process in the transposition table
+        and remember it to send it back with the game.
+    :param key: (zobrist hash, ply, move) of the position
+    :param entry: (best move, played move) of the position
+    """
+    tt_insert(key, entry)
+    _TT_NEW.append((key, entry))
+
+
+def tt_insert(key, entry):
+    """
+        Store an analyzed position in the transposition table.
+        The least recently used position is dropped when the table is full.
+    :param key: (zobrist hash, ply, move) of the position
+    :param entry: (best move, played move) of the position
+    """
+    TT[key] = entry
+    if len(TT) > TT_SIZE:
+        TT.popitem(last=False)
+
+
+def load_tt(filename, engine_path):
     """
-        Read all the games of a pgn file
-        Input:
+        Load the transposition table saved by a previous run.
+        The table is only reused if it was created with the same engine.
+    :param filename: [string] Name of the file with the table
+    :param engine_path: [string] Path of the engine
+    """
+    if not os.path.isfile(filename):
+        return
+    with open(filename, 'rb') as tt_file:
+        saved = pickle.load(tt_file)
+    if saved['engine'] == engine_path:
+        TT.update(saved['tt'])
+        print('Positions loaded: {}'.format(len(TT)))
+
+
+def save_tt(filename, engine_path):
+    """
+        Save the transposition table for the next runs.
+    :param filename: [string] Name of the file with the table
+    :param engine_path: [string] Path of the engine
+    """
+    with open(filename, 'wb') as tt_file:
+        pickle.dump({'engine': engine_path, 'tt': TT}, tt_file,
+                    pickle.HIGHEST_PROTOCOL)
+
+
+def split_pgn(pgn_map):
+    """
+        Find where every game of a pgn file begins and ends.
+        It only looks for the [Event tag at the beginning of a line, which
+        bytes.find does in C, so the games are not parsed.
+        :param pgn_map: [mmap] pgn file mapped in memory
+        :return: Generator with the (start, end) bytes of each game
+    """
+    start = pgn_map.find(PGN_GAME_START[1:])
+    while start != -1:
+        end = pgn_map.find(PGN_GAME_START, start)
+        if end == -1:
+            yield start, len(pgn_map)
+            break
+        yield start, end + 1
+        start = end + 1
+
+
+def header_value(regex, pgn_map, start, end):
+    """
+        Get the value of a header of a game without parsing the game.
+        :param regex: Compiled regex of the header
+        :param pgn_map: [mmap] pgn file mapped in memory
+        :param start: First byte of the game
+        :param end: Last byte of the game
+        :return: Value of the header or '?' if the game does not have it.
+                 The escaped characters are kept as they are, like
+                 chess.pgn does, so it can be compared with game.headers
+    """
+    found = regex.search(pgn_map, start, end)
+    if found is None:
+        return '?'
+    return found.group(1).decode(PGN_ENCODING, 'replace')
+
+
+def read_pgn_index(filename):
+    """
+        Read the position and the players of every game of a pgn file.
+        The first time the file is split in games and only the White and
+        Black headers are searched, which is much faster than reading the
+        games, and the result is saved next to the pgn file
+        (<pgn file>.idx) for the next runs.
         :param filename: [string] Name of the pgn file
-        :return: all_games [list] List with all the games
+        :return: List with the ((start, end), white, black) of each game
+    """
+    idx_filename = filename + '.idx'
+    pgn_stat = os.stat(filename)
+    if os.path.isfile(idx_filename):
+        with open(idx_filename, 'rb') as idx_file:
+            saved = pickle.load(idx_file)
+        # The index is only valid for the same version of the pgn file
+        if (saved.get('version'), saved['size'], saved['mtime']) == \
+                (PGN_INDEX_VERSION, pgn_stat.st_size, pgn_stat.st_mtime):
+            return saved['games']
+    pgn_index = []
+    if pgn_stat.st_size > 0:
+        with open(filename, 'rb') as pgn_file, \
+                mmap.mmap(pgn_file.fileno(), 0,
+                          access=mmap.ACCESS_READ) as pgn_map:
+            for start, end in split_pgn(pgn_map):
+                pgn_index.append(
+                    ((start, end),
+                     header_value(PGN_WHITE_REGEX, pgn_map, start, end),
+                     header_value(PGN_BLACK_REGEX, pgn_map, start, end)))
+    try:
+        with open(idx_filename, 'wb') as idx_file:
+            pickle.dump({'version': PGN_INDEX_VERSION,
+                         'size': pgn_stat.st_size,
+                         'mtime': pgn_stat.st_mtime,
+                         'games': pgn_index},
+                        idx_file, pickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError):
+        print('Not able to save the index {}'.format(idx_filename))
+    return pgn_index
+
+
+def read_games(filename, positions):
+    """
+        Read some games of a pgn file, one game at a time.
+        Only the game being used is kept in memory.
+        :param filename: [string] Name of the pgn file
+        :param positions: [list] (start, end) bytes of the games to read
+        :return: Generator with the games
+    """
+    with open(filename, 'rb') as pgn_file, \
+            mmap.mmap(pgn_file.fileno(), 0,
+                      access=mmap.ACCESS_READ) as pgn_map:
+        for start, end in positions:
+            pgn_text = pgn_map[start:end].decode(PGN_ENCODING, 'replace')
+            yield chess.pgn.read_game(io.StringIO(pgn_text))
+
+
+def index_players(filename):
+    """
+        Index the games of every player of a pgn file.
+    :param filename: [string] Name of the pgn file
+    :return: Dictionary with the name of the player and the list with the
+             (start, end) bytes in the pgn file of the games of the player
     """
-    print ' Reading PGN file '.center(40, '*')
-    all_games = []
-    game_ok = True
+    print(' Reading PGN headers '.center(40, '*'))
+    index = collections.defaultdict(list)
     t0 = time.time()
-    with open(filename, 'r') as pgn_file:
-        while game_ok:
-            new_game = chess.pgn.read_game(pgn_file)
-            if new_game:
-                all_games.append(new_game)
-            else:
-                game_ok = False
+    pgn_index = read_pgn_index(filename)
+    for position, white, black in pgn_index:
+        index[white].append(position)
+        if black != white:
+            index[black].append(position)
     t1 = time.time()
-    print 'Total number of games: {}'.format(len(all_games))
-    print 'Time: {:.2f} seconds'.format(t1 - t0)
-    print 40 * '-'
+    print('Total number of games: {}'.format(len(pgn_index)))
+    print('Time: {:.2f} seconds'.format(t1 - t0))
+    print(40 * '-')
 
-    return all_games
+    return index
 
 
-def find_player(pgn_games, name):
+def find_player(index, name):
     """
-    Find a player in a pgn file using regular expressions.
-    :param pgn_games: list of pgn games to parse
+    Find a player in the index of a pgn file using regular expressions.
+    Only the names of the players are searched, not every game.
+    :param index: index of the players of the pgn file (see index_players)
     :param name: Name or part of the name of the player
     :return: If there are several matches, the list of coincidences
-             If there is only one match, the name and the list of matches
+             If there is only one match, the name and the number of games
+             of the player
     """
-    print 'Searching for players matching: "{}"'.format(name)
-    all_found = []
-    all_games = []
-    for game in pgn_games:
-        if re.search(name, game.headers['White'], flags=re.IGNORECASE):
-            all_found.append(game.headers['White'])
-            all_games.append(game)
-        if re.search(name, game.headers['Black'], flags=re.IGNORECASE):
-            all_found.append(game.headers['Black'])
-            all_games.append(game)
-    unique_players = list(set(all_found))
+    print('Searching for players matching: "{}"'.format(name))
+    if REGEX_CHARS.isdisjoint(name):
+        # Plain name: a substring search is much faster than a regex
+        name_lower = name.lower()
+
+        def match(value):
+            return name_lower in value.lower()
+    else:
+        match = re.compile(name, flags=re.IGNORECASE).search
+    unique_players = [player for player in index if match(player)]
+    number_of_games = 0
     if len(unique_players) > 1:
-        print 'Several players found:'
+        print('Several players found:')
         for name in unique_players:
-            print '\t{}'.format(name)
+            print('\t{}'.format(name))
         sys.exit()
     elif len(unique_players) == 1:
-        print 'Player found:\n\t{}'.format(unique_players[0])
+        print('Player found:\n\t{}'.format(unique_players[0]))
         unique_players = unique_players[0]
+        number_of_games = len(index[unique_players])
         # player = player(name_found[0])
     else:
-        print 'No player found.'
-    print 40 * '-'
+        print('No player found.')
+    print(40 * '-')
 
-    return unique_players, all_games
+    return unique_players, number_of_games
 
 
 def find_all_players(pgn_games):
@@ -142,58 +369,53 @@ def find_all_players(pgn_games):
     :param pgn_games: [list] List with all the games
     :return: List with all the players
     """
-    all_players = []
+    # Dictionary used as an ordered set of the players
+    all_players = {}
     for game in pgn_games:
-        all_players.append(game.headers['White'])
-        all_players.append(game.headers['Black'])
-    return list(set(all_players))
+        all_players[game.headers['White']] = None
+        all_players[game.headers['Black']] = None
+    return list(all_players)
 
 
 def game_to_paired_list(game):
     """
         Create a list with the movements grouped in pairs of the game.
     :param game: Game to print
-    :return: List with the movements of the game in pairs [(w1,b1),(w2,b2)...]
+    :return: List with the movements of the game in pairs, in SAN and as
+             chess.Move to push them without parsing the SAN again
+             [(w1,b1,w1_move,b1_move),(w2,b2,w2_move,b2_move)...]
     """
-    move_list = []
-    # print '{} vs {}'.format(game.headers['white'], game.headers['black'])
-    node = game
-    # move_number = 1
-    while not node.is_end():
-        # white move
-        next_node = node.variation(0)
-        white_move = node.board().san(next_node.move)
-        node = next_node
-        # black move
-        if not node.is_end():
-            next_node = node.variation(0)
-            black_move = node.board().san(next_node.move)
-            node = next_node
-        else:
-            black_move = ''
-        move_list.append((white_move, black_move))
-        # print '{:3}.  {:6}\t{:6}'.format(move_number, white_move, black_move)
-        # move_number = move_number + 1
-
-    return move_list
+    san_moves = iter(game_to_list(game))
+    moves = iter(game.mainline_moves())
+    san_pairs = itertools.zip_longest(san_moves, san_moves, fillvalue='')
+    move_pairs = itertools.zip_longest(moves, moves)
+    return [san_pair + move_pair
+            for san_pair, move_pair in zip(san_pairs, move_pairs)]
 
 
 def game_to_list(game):
     """
         Create a list with the movements of the game.
+        The board is carried along the main line instead of being rebuilt
+        from the start of the game for every move.
     :param game: Game(chess.pgn.Game) to print
     :return: List with the movements of the game [w1,b1,w2,b2,...]
     """
     move_list = []
-    node = game
-    while not node.is_end():
-        next_node = node.variation(0)
-        move = node.board().san(next_node.move)
-        node = next_node
-        move_list.append(move)
+    board = game.board()
+    for move in game.mainline_moves():
+        move_list.append(board.san(move))
+        board.push(move)
     return move_list
 
 
+try:
+    # Compiled versions of the helpers above, built from ap_fast.pyx
+    from ap_fast import game_to_list, game_to_paired_list
+except ImportError:
+    pass
+
+
 def analyze_game(game, machine, depths, player):
     """
         Analyze a game
@@ -205,77 +427,193 @@ def analyze_game(game, machine, depths, player):
         :return: Game analyzed
     """
 
-    def analyze_move(machine, stats, ply, move):
+    def analyze_move(machine, stats, board, ply, move, played):
         """
             Analyze one move and its best move
 
             :param machine: Machine with the position to analyze
-            :param move:    Move to analyze
             :param stats:   InfoHandler to store statistics
+            :param board:   Position to analyze
             :param ply:     Depth of analysis
+            :param move:    Move to analyze
+            :param played:  Move to analyze as chess.Move
             :return: best move, move and new status of the machine
         """
         best_move = Move()
         played_move = Move()
 
+        # The position is only sent when the engine has to search it. The
+        # root is the start position, so it is sent as startpos + moves.
+        machine.engine.position(board)
         # Play best move
         machine.engine.go(depth=ply).bestmove
         best_move.fill(stats)
         best_move.move = board.san(best_move.move)
+        if best_move.move == move:
+            # The move played is the best move: it has already been searched
+            return best_move, best_move
+        # The move played may be one of the other best lines (MultiPV)
+        for line, pv in stats.info['pv'].items():
+            if pv[0] == played:
+                played_move.fill(stats, line)
+                played_move.move = move
+                return best_move, played_move
+        # Same position as the previous search, so the engine keeps its hash
+        # (no ucinewgame) and the restricted search starts from it
         machine.engine.go(depth=ply,
-                          searchmoves=[board.parse_san(move)]
+                          searchmoves=[played]
                           )
         played_move.fill(stats)
         played_move.move = board.san(played_move.move)
 
         return best_move, played_move
 
+    def put(positions, stop, item):
+        """
+            Put an item in the queue, waiting until there is room unless
+            the analysis stops.
+
+            :param positions: Queue of the positions to analyze
+            :param stop: Event set when the analysis stops
+            :param item: Item to put
+            :return: True if the item was put, False if the analysis stopped
+        """
+        while not stop.is_set():
+            try:
+                positions.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def prepare_positions(positions, stop):
+        """
+            Push the moves of the game and queue the positions to analyze.
+            It runs in its own thread, so this Python work is done while the
+            main thread waits for the engine (the GIL is released).
+
+            :param positions: Queue with (board, zobrist hash, move, played)
+                              of the positions to analyze, None at the end
+                              or the exception if the thread fails
+            :param stop: Event set when the analysis stops before the end,
+                         so the thread does not wait forever on a full queue
+        """
+        try:
+            # The game may start from a [FEN] setup
+            board = game.board()
+            for position, move in enumerate(game_to_paired_list(game)):
+                if game.headers['White'] == player:
+                    # Before analyze the next withe move, push the previous
+                    # black move. Except for the first move
+                    if position > 0:
+                        board.push(previous_black_move)
+                    column = 0
+                elif game.headers['Black'] == player:
+                    # White goes first
+                    board.push(move[2])
+                    column = 1
+                # In case that there is black time and it draws without doing
+                # the move
+                if move[column] != '':
+                    if not put(positions, stop,
+                               (board.copy(),
+                                chess.polyglot.zobrist_hash(board),
+                                move[column],
+                                move[column + 2])):
+                        return
+                    # Push move
+                    board.push(move[column + 2])
+                    previous_black_move = move[3]
+        except Exception as ex:
+            # Raised again by analyze_game, in the thread of the caller
+            put(positions, stop, ex)
+        else:
+            put(positions, stop, None)
+
     analyzed_game = []
-    paired_moves = game_to_paired_list(game)
-    board = chess.Board()
     machine.engine.ucinewgame()
-    machine.engine.position(board)
     stats = chess.uci.InfoHandler()
     machine.engine.info_handlers.append(stats)
+    positions = queue.Queue(maxsize=POSITIONS_AHEAD)
+    stop = threading.Event()
+    producer = threading.Thread(target=prepare_positions,
+                                args=(positions, stop))
+    producer.daemon = True
+    producer.start()
 
-    for position, move in enumerate(paired_moves):
-        if game.headers['White'] == player:
-            # Before analyze the next withe move, push the previous black move
-            # Except for the first move
-            if position > 0:
-                board.push(board.parse_san(previous_black_move))
-                machine.engine.position(board)
-            column = 0
-        elif game.headers['Black'] == player:
-            # White goes first
-            board.push(board.parse_san(move[0]))
-            machine.engine.position(board)
-            column = 1
-        csv_move = str(move[column])
-        # In case that there is black time and it draws without doing the move
-        if move[column] != '':
+    try:
+        for position in iter(positions.get, None):
+            if isinstance(position, Exception):
+                raise position
+            board, position_hash, move, played = position
+            csv_move = [str(move)]
             for ply in depths:
-                best_move, played_move = analyze_move(machine,
-                                                      stats,
-                                                      ply,
-                                                      move[column]
-                                                      )
-                csv_move = csv_move + ';' + \
-                                      ';'.join([str(ply),
-                                                str(played_move.cp),
-                                                str(best_move.move),
-                                                str(best_move.cp)
-                                               ]
-                                              )
-            analyzed_game.append(csv_move)
+                key = (position_hash, ply, move)
+                analyzed_move = tt_get(key)
+                if analyzed_move is None:
+                    analyzed_move = analyze_move(machine,
+                                                 stats,
+                                                 board,
+                                                 ply,
+                                                 move,
+                                                 played
+                                                 )
+                    tt_put(key, analyzed_move)
+                best_move, played_move = analyzed_move
+                csv_move.extend([str(ply),
+                                 str(played_move.cp),
+                                 str(best_move.move),
+                                 str(best_move.cp)
+                                 ])
+            analyzed_game.append(';'.join(csv_move))
             # print csv_move
-            # Push move
-            board.push(board.parse_san(move[column]))
-            machine.engine.position(board)
-            previous_black_move = move[1]
+    finally:
+        # Also when the analysis fails: stop the producer and remove the
+        # handler, so neither outlives the game
+        stop.set()
+        producer.join()
+        machine.engine.info_handlers.remove(stats)
     return analyzed_game
 
 
+def _init_worker(engine_path, threads, hash_mb, multi_pv, depths, player,
+                 tt):
+    """
+        Initialize a worker process of the analysis pool.
+        Each worker starts its own engine, quit when the worker exits.
+    :param engine_path: Path of the chess engine executable
+    :param threads: Number of search threads of the engine
+    :param hash_mb: Size in MB of the hash table of the engine
+    :param multi_pv: Number of best lines searched by the engine
+    :param depths: List with the depths of analysis
+    :param player: Name of the player to analyze
+    :param tt: Transposition table loaded by the main process
+    """
+    global _WORKER_ENGINE, _WORKER_DEPTHS, _WORKER_PLAYER
+    TT.update(tt)
+    _WORKER_ENGINE = Engine(engine_path, threads, hash_mb, multi_pv)
+    _WORKER_DEPTHS = depths
+    _WORKER_PLAYER = player
+    # atexit handlers are not run by pool workers, finalizers are
+    multiprocessing.util.Finalize(_WORKER_ENGINE, _WORKER_ENGINE.quit,
+                                  exitpriority=10)
+
+
+def _analyze_one(pgn_text):
+    """
+        Analyze one game with the engine of the worker process.
+    :param pgn_text: [string] PGN text of the game, cheaper to send to the
+                     worker than the chess.pgn.Game tree
+    :return: Game analyzed and the new entries of the transposition table
+    """
+    game = chess.pgn.read_game(io.StringIO(pgn_text))
+    analyzed_game = analyze_game(game, _WORKER_ENGINE, _WORKER_DEPTHS,
+                                 _WORKER_PLAYER)
+    new_entries = list(_TT_NEW)
+    _TT_NEW.clear()
+    return analyzed_game, new_entries
+
+
 def output_result(output_file, all_analyzed_games, plys):
     """
         Print or save result
@@ -284,33 +622,37 @@ def output_result(output_file, all_analyzed_games, plys):
         :param plys: All the plys that have been requested
         :return: Printed or saved results
     """
-    print 'Printing results '.center(40, '*')
-    all_difs = []
+    print('Printing results '.center(40, '*'))
+    # Running sum and count of the differences per ply
+    difs_sum = [0.0] * len(plys)
+    difs_count = [0] * len(plys)
     # Header for the CSV file
-    csv_header = 'Move;'
+    csv_header = ['Move']
     for p in plys:
-        csv_header += 'ply;cp move;best move;cp best move;'
-        all_difs.append([])
+        csv_header.append('ply;cp move;best move;cp best move')
+    csv_header = ';'.join(csv_header)
     if output_file:
-        csv_file = open(output_file, 'w')
-        csv_file.write(csv_header[:-1] + '\n')
+        csv_file = open(output_file, 'w', CSV_BUFFER_SIZE)
+        csv_file.write(csv_header + '\n')
     else:
-        print csv_header[:-1]
+        print(csv_header)
     # Values
     for game in all_analyzed_games:
+        if output_file:
+            csv_file.writelines([move + '\n' for move in game])
         for move in game:
-            if output_file:
-                csv_file.write(move + '\n')
-            else:
-                print move
+            if not output_file:
+                print(move)
             aux = move.split(';')[2::2]
             for p in range(len(plys)):
-                all_difs[p] = all_difs[p] + \
-                              [(float(aux[2 * p + 1]) - float(aux[2 * p]))]
+                difs_sum[p] += float(aux[2 * p + 1]) - float(aux[2 * p])
+                difs_count[p] += 1
+    if output_file:
+        csv_file.close()
     # Averages per ply
-    for d in range(len(all_difs)):
-        print 'Average for {} plys: {:+.2f}' \
-            .format(plys[d], sum(all_difs[d]) / len(all_difs[d]))
+    for d in range(len(plys)):
+        print('Average for {} plys: {:+.2f}'
+              .format(plys[d], difs_sum[d] / difs_count[d]))
 
 
 def main():
@@ -320,27 +662,46 @@ def main():
     args = arguments()
     all_analyzed_games = []
 
-    # Read games from .pgn file
-    all_games = read_all_pgn(args.pgn_file)
-
-    # Search for player
-    player_name, games_of_the_player = find_player(all_games, args.player)
-
-    # Create chess engine
-    chess_engine = Engine(args.engine)
+    # Search for player, reading only the headers of the .pgn file
+    index = index_players(args.pgn_file)
+    player_name, number_of_games = find_player(index, args.player)
+
+    # Create a pool of workers, each one with its own chess engine.
+    # The cores and the hash are shared among the engines of the pool.
+    check_engine(args.engine)
+    threads = args.threads or max(1, multiprocessing.cpu_count() // args.jobs)
+    hash_mb = max(1, args.hash // args.jobs)
+    if args.tt:
+        load_tt(args.tt, args.engine)
+    pool = multiprocessing.Pool(processes=args.jobs,
+                                initializer=_init_worker,
+                                initargs=(args.engine, threads, hash_mb,
+                                          args.multipv, args.ply, player_name,
+                                          TT))
 
     # Begin of analysis
     t0 = time.time()
     game_number = 1
-    for game in games_of_the_player:
-        print 'Analyzing game {} of {}\r'.format(game_number, len(all_games)),
-        analyzed_game = analyze_game(game, chess_engine, args.ply, player_name)
+    # Only the games of the player are read from the .pgn file, as they are
+    # sent to the workers
+    games_pgn = (str(game) for game in
+                 read_games(args.pgn_file,
+                            index[player_name] if number_of_games else []))
+    for analyzed_game, new_entries in pool.imap(_analyze_one, games_pgn):
+        print('Analyzing game {} of {}\r'.format(game_number,
+                                                 number_of_games),
+              end='', flush=True)
         game_number += 1
         all_analyzed_games.append(analyzed_game)
+        for key, entry in new_entries:
+            tt_insert(key, entry)
     t1 = time.time()
-    chess_engine.quit()
-    print 'Analysis time: {:.2f} seconds ({:.3f} sec / game)' \
-        .format(t1 - t0, (t1 - t0) / len(all_games))
+    pool.close()
+    pool.join()
+    if args.tt:
+        save_tt(args.tt, args.engine)
+    print('Analysis time: {:.2f} seconds ({:.3f} sec / game)'
+          .format(t1 - t0, (t1 - t0) / max(number_of_games, 1)))
     # Results
     output_result(args.output_file, all_analyzed_games, args.ply)
 
@@ -374,6 +735,34 @@ def arguments():
                         action='store',
                         type=str,
                         help='Chess engine to use for the analysis.')
+    parser.add_argument('-j', '--jobs',
+                        action='store',
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of engines analyzing games in parallel.')
+    parser.add_argument('-t', '--threads',
+                        action='store',
+                        type=int,
+                        help='Search threads per engine. '
+                             'Default: number of CPUs / jobs')
+    parser.add_argument('--hash',
+                        action='store',
+                        type=int,
+                        default=default_hash_mb(),
+                        help='Total hash size in MB for all the engines. '
+                             'Default: 1/4 of the RAM, up to 4096')
+    parser.add_argument('--multipv',
+                        action='store',
+                        type=int,
+                        default=5,
+                        help='Number of best lines searched by the engine. '
+                             'The move played is searched again only when '
+                             'it is not in one of them.')
+    parser.add_argument('--tt',
+                        action='store',
+                        type=str,
+                        help='File to keep the analyzed positions between '
+                             'runs.')
     parser.add_argument('-o', '--output_file',
                         action='store',
                         type=str,
@@ -384,14 +773,13 @@ def arguments():
 
 
 if __name__ == '__main__':
-    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
     # sys.tracebacklimit=0
-    if sys.version_info < (2, 7):
-        print 'Python 2.7 or higher required'
+    if sys.version_info < (3, 5):
+        print('Python 3.5 or higher required')
         sys.exit(9)
     # Main function
     try:
         main()
     except KeyboardInterrupt:
-        print "\nProgram interrupted by CTRL-C.\n"
+        print("\nProgram interrupted by CTRL-C.\n")
         sys.exit()
@@ -0,0 +1,44 @@
+# cython: language_level=3
+"""Compiled versions of the PGN traversal helpers of ap.py.
+
+ap.py uses them instead of its pure Python versions when this module is
+built. Build it next to ap.py with::
+    $ cythonize -3 -i ap_fast.pyx
+"""
+
+
+def game_to_list(game):
+    """
+        Create a list with the movements of the game.
+    :param game: Game(chess.pgn.Game) to print
+    :return: List with the movements of the game [w1,b1,w2,b2,...]
+    """
+    cdef list move_list = []
+    cdef object board = game.board()
+    cdef object move
+    for move in game.mainline_moves():
+        move_list.append(board.san(move))
+        board.push(move)
+    return move_list
+
+
+def game_to_paired_list(game):
+    """
+        Create a list with the movements grouped in pairs of the game.
+    :param game: Game to print
+    :return: List with the movements of the game in pairs, in SAN and as
+             chess.Move to push them without parsing the SAN again
+             [(w1,b1,w1_move,b1_move),(w2,b2,w2_move,b2_move)...]
+    """
+    cdef list san_moves = game_to_list(game)
+    cdef list moves = list(game.mainline_moves())
+    cdef list move_list = []
+    cdef Py_ssize_t i
+    cdef Py_ssize_t n = len(moves)
+    for i in range(0, n, 2):
+        if i + 1 < n:
+            move_list.append((san_moves[i], san_moves[i + 1],
+                              moves[i], moves[i + 1]))
+        else:
+            move_list.append((san_moves[i], '', moves[i], None))
+    return move_list
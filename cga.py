@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """Analyze chess games against a chess engines to see de deviation.
 
@@ -8,12 +8,28 @@ Example::
 
 import os
 import sys
+import io
+import array
 import argparse
 import logging
+import multiprocessing
+import multiprocessing.util
 import time
 import re
+import collections
+import functools
+import pickle
+import dbm
+import shelve
+import numpy as np
+import chess.engine
 import chess.pgn
-import chess.uci
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Without numba the functions are run by the interpreter."""
+        return lambda function: function
 
 __author__ = "Carlos Alamo"
 __email__ = "my@email.com"
@@ -24,6 +40,20 @@ __version__ = "1.00"
 COLOURS = ['White', 'Black']
 NONAME = 'Noname'
 POSITIONS = [1, 2, 3]
+TT_SIZE = 1000000
+# v2: scores stored as the Score namedtuple instead of chess.uci.Score
+TT_FILE = '.cga_tt_{}.v2.db'
+REGEX_CHARS = set('.^$*+?{}[]\\|()')
+PGN_ENCODING = 'utf-8'
+
+# Score from the point of view of the side to move, centipawns or mate in
+Score = collections.namedtuple('Score', ['cp', 'mate'])
+
+# General logger
+logger = logging.getLogger(__name__)
+
+# Engine of each process of the pool
+_WORKER_ENGINE = None
 
 
 class Move(object):
@@ -32,11 +62,11 @@ class Move(object):
         :var self.move: Move done
         :vartype self.move: str
         :var self.best_move: Best move according the engine
-        :vartype self.best_move: chess.uci.Score
+        :vartype self.best_move: Score
         :var self.cp: Centipawns of the move
         :vartype self.cp: int
         :var self.bm_score: Score of the best move
-        :vartype self.bm_cp: chess.uci.Score
+        :vartype self.bm_cp: Score
         :var self.cp_diff: Difference between the move and the best move
         :vartype self.cp_diff: int
         :var self.best_move_position: Position of the move done in the list of
@@ -46,13 +76,18 @@ class Move(object):
         :vartype self.best_move_position: int
     """
 
-    def __init__(self, move, cp, bm, bm_score, bmp=0):
-        """Init definition for Move class."""
+    def __init__(self, move, cp, bm, bm_score, bmp=0, cp_diff=None):
+        """Init definition for Move class.
+
+            cp_diff is calculated from cp and bm_score if it is not given.
+        """
         self.move = move
         self.cp = cp
         self.bm = bm.strip()
         self.bm_score = bm_score
-        self.cp_diff = self._cp_diff_calculation(self.cp, self.bm_score)
+        if cp_diff is None:
+            cp_diff = self._cp_diff_calculation(self.cp, self.bm_score)
+        self.cp_diff = cp_diff
         self.best_move_position = bmp
 
     def _cp_diff_calculation(self, cp, bm_cp):
@@ -61,32 +96,30 @@ class Move(object):
            White is + and black is - so you will have to add to get the diff.
            Args:
                 :arg cp:    Score of the move
-                :type cp:   chess.uci.Score
+                :type cp:   Score
                 :arg bm_cp: Score of the best move
-                :type bm_cp: chess.uci.Score
+                :type bm_cp: Score
             Returns:
                 :return diff_score: Score with the difference
-                :rtype diff_score:  chess.uci.Score
+                :rtype diff_score:  Score
         """
         if cp.mate is not None and bm_cp.mate is not None:
-            diff_score = chess.uci.Score(0, bm_cp.mate + cp.mate)
+            diff_score = Score(0, bm_cp.mate + cp.mate)
         elif cp.cp is not None and bm_cp.cp is not None:
-            diff_score = chess.uci.Score(bm_cp.cp + cp.cp, None)
+            diff_score = Score(bm_cp.cp + cp.cp, None)
         elif cp.mate is not None and bm_cp.cp is not None:
-            diff_score = chess.uci.Score(bm_cp.cp, cp.mate)
+            diff_score = Score(bm_cp.cp, cp.mate)
         elif cp.cp is not None and bm_cp.mate is not None:
-            diff_score = chess.uci.Score(cp.cp, bm_cp.mate)
+            diff_score = Score(cp.cp, bm_cp.mate)
 
         return diff_score
 
     def __str__(self):
         """Print the move and the best move with its stats."""
-        return '{:5s} {{bm={:10s} cp={:7} diff={:7} pos={}}}'.\
-            format(self.move,
-                   self.bm,
-                   parse_score(self.bm_score),
-                   parse_score(self.cp_diff),
-                   self.best_move_position)
+        bm_score = parse_score(self.bm_score)
+        cp_diff = parse_score(self.cp_diff)
+        return (f'{self.move:5s} {{bm={self.bm:10s} cp={bm_score:7} '
+                f'diff={cp_diff:7} pos={self.best_move_position}}}')
 
 
 class Player(object):
@@ -129,19 +162,18 @@ class Player(object):
                 :type game:    [chess.pgn.Game]
         """
         self.all_games.append(game)
-        # Update number of plys
-        self.number_plys = 0
-        self.total_number_plys()
-        # Update statistics and average statistics
-        self.initialize_stats()
-        self.get_stats()
+        # Update statistics and average statistics with the new game only
+        self._accumulate_game(game)
         self.avg_stats()
 
     def initialize_stats(self):
         """Initialize the stats of the player."""
         self.engine_stats = {'cp_avg': [],
                              'diff_avg': [],
-                             'position': []}
+                             'position': np.zeros(max(POSITIONS) + 1,
+                                                  dtype=np.int64)}
+        self._cp_sum = 0.0
+        self._diff_sum = 0.0
         self.cp_avg = 0.0,
         self.diff_avg = 0.0,
         self.position_avg = {}
@@ -149,54 +181,41 @@ class Player(object):
             self.position_avg[pos] = 0.0
         self.top_3_avg = 0.0
 
-    def get_stats(self):
-        """Get statistics of all the games of this player."""
-        for game in self.all_games:
-            cp_avg, diff_avg, position =\
-                game.average_analyzed_game()
-            if self.name == NONAME:
-                sides = COLOURS
-            elif self.name == game.headers['White']:
-                sides = ['White']
-            elif self.name == game.headers['Black']:
-                sides = ['Black']
-            for side in sides:
-                self.engine_stats['cp_avg'].append(cp_avg[side])
-                self.engine_stats['diff_avg'].append(diff_avg[side])
-                self.engine_stats['position'].append(position[side])
+    def _accumulate_game(self, game):
+        """Add the statistics and the plys of a game to the running totals.
+
+            Args:
+                :arg game:     Game played by the player
+                :type game:    Game
+        """
+        cp_avg, diff_avg, _ = game.average_analyzed_game()
+        if self.name == NONAME:
+            sides = COLOURS
+        elif self.name == game.headers['White']:
+            sides = ['White']
+        elif self.name == game.headers['Black']:
+            sides = ['Black']
+        positions = self.engine_stats['position']
+        for side in sides:
+            self.engine_stats['cp_avg'].append(cp_avg[side])
+            self.engine_stats['diff_avg'].append(diff_avg[side])
+            self._cp_sum += cp_avg[side]
+            self._diff_sum += diff_avg[side]
+            positions += np.bincount(game.pos_arr[side],
+                                     minlength=len(positions))[:len(positions)]
+        for colour in COLOURS:
+            if self.name == game.headers[colour]:
+                self.number_plys += game.number_plys[colour]
 
     def avg_stats(self):
         """Average statistics of all the games of the player."""
-        def average(values):
-            """Average of a list."""
-            return sum(values) / len(values)
-
-        cp_aux = 0.0
-        diff_aux = 0.0
-        pos_aux = {}
-        for pos in POSITIONS:
-            pos_aux[pos] = 0
-        cp_aux += average(self.engine_stats['cp_avg'])
-        diff_aux += average(self.engine_stats['diff_avg'])
-        for game in self.engine_stats['position']:
-            for pos in POSITIONS:
-                if pos in game.keys():
-                    pos_aux[pos] += game[pos]
-        self.cp_avg = cp_aux
-        self.diff_avg = diff_aux
-        sum_top_3_aux = 0
-        for pos in pos_aux.keys():
-            sum_top_3_aux += pos_aux[pos]
-            self.position_avg[pos] =\
-                float(pos_aux[pos]) / self.number_plys * 100
-        self.top_3_avg = float(sum_top_3_aux) / self.number_plys * 100
-
-    def total_number_plys(self):
-        """The total number of moves done by the player."""
-        for game in self.all_games:
-            for colour in COLOURS:
-                if self.name == game.headers[colour]:
-                    self.number_plys += game.number_plys[colour]
+        self.cp_avg = self._cp_sum / len(self.engine_stats['cp_avg'])
+        self.diff_avg = self._diff_sum / len(self.engine_stats['diff_avg'])
+        # Times that the move was in each position of the best moves
+        pos_count = self.engine_stats['position'][POSITIONS]
+        for pos, count in zip(POSITIONS, pos_count):
+            self.position_avg[pos] = float(count) / self.number_plys * 100
+        self.top_3_avg = float(pos_count.sum()) / self.number_plys * 100
 
     def print_stats(self):
         """Print statistics of the player."""
@@ -220,51 +239,199 @@ class Player(object):
 class Engine(object):
     """Engine use for the analysis.
 
-        You can access all the chess.uci methods calling <name>.engine.<method>
+        You can access all the chess.engine.SimpleEngine methods calling
+        <name>.engine.<method>
 
         :var multi_pv: MultiPV value
         :type multi_pv: int
+        :var tt: Transposition table with the positions already searched,
+                 the least recently used are dropped after TT_SIZE entries
+        :type tt: collections.OrderedDict
+        :var tt_file: File of the transposition table stored in disk between
+                      runs, one per engine (TT_FILE)
+        :type tt_file: str
+        :var disk_tt: Transposition table stored in disk, opened read only,
+                      the caller saves the new entries with save_disk_tt
+        :type disk_tt: shelve.Shelf
+        :var new_entries: Searches done by the engine that were not in the
+                          transposition tables
+        :type new_entries: dict
     """
 
-    def __init__(self, path):
-        """Check that the engine executable exists and start it."""
+    def __init__(self, path, persistent_tt=True, threads=None, hash_mb=None):
+        """Check that the engine executable exists and start it.
+
+            Args:
+                :arg path:          Path to the engine executable
+                :type path:         str
+                :arg persistent_tt: Read the transposition table stored in
+                                    disk
+                :type persistent_tt: bool
+                :arg threads:       Search threads of the engine
+                :type threads:      int
+                :arg hash_mb:       Size in MB of the hash of the engine
+                :type hash_mb:      int
+        """
         if not os.path.isfile(path):
             logger.error('Engine %s does not exists.', path)
             sys.exit(1)
-        self.engine = chess.uci.popen_engine(path)
-        self.engine.uci()
-        self.name = self.engine.name
+        # chess.engine sends ucinewgame only before the first search, so the
+        # engine keeps its hash tables between games
+        self.engine = chess.engine.SimpleEngine.popen_uci(path)
+        self.name = self.engine.id.get('name', os.path.basename(path))
         self.multi_pv = self.engine.options['MultiPV'].default
+        options = {}
+        if threads and 'Threads' in self.engine.options:
+            options['Threads'] = threads
+        if hash_mb and 'Hash' in self.engine.options:
+            options['Hash'] = hash_mb
+        if options:
+            self.engine.configure(options)
+        self.tt = collections.OrderedDict()
+        self.tt_file = TT_FILE.format(re.sub(r'\W+', '_', self.name))
+        self.disk_tt = None
+        self.new_entries = {}
+        if persistent_tt:
+            try:
+                self.disk_tt = shelve.open(self.tt_file, flag='r')
+                logger.debug('Transposition table %s: %d positions',
+                             self.tt_file, len(self.disk_tt))
+            except dbm.error:
+                # Not created yet, the first run has nothing to read
+                logger.debug('No transposition table %s', self.tt_file)
 
     def set_multi_pv(self, multi_pv):
         """Manage MultiPV option.
 
         Check if the option MultiPV exisits and set it to the maximum allowed
-        by the engine.
+        by the engine. chess.engine sends the option with every search.
         """
         max_multi_pv = 0
         self.multi_pv = multi_pv
-        if 'MultiPV' in self.engine.options.keys():
+        if 'MultiPV' in self.engine.options:
             try:
                 max_multi_pv = self.engine.options['MultiPV'].max
             except:
                 logger.warning('Not able to get maximum MultiPV.')
             if self.multi_pv > 0 and max_multi_pv > 1:
-                self.engine.setoption({'MultiPV': self.multi_pv})
-                logger.debug('Set MultiPV to: {}'.format(self.multi_pv))
+                logger.debug('Set MultiPV to: %s', self.multi_pv)
             elif multi_pv == 0 and max_multi_pv > 1:
-                self.engine.setoption({'MultiPV': max_multi_pv})
-                logger.debug('Set MultiPV to: {}'.format(max_multi_pv))
+                self.multi_pv = max_multi_pv
+                logger.debug('Set MultiPV to: %s', max_multi_pv)
             else:
                 logger.warning('Error setting maximum MultiPV.')
 
+    def start_search(self, board, tpm=None, ply=None):
+        """Start to search a position without waiting for the result.
+
+            The board can be changed once this returns, the position is
+            already sent to the engine. Only one search can be pending.
+            Args:
+                :arg board:     Position to search
+                :type board:    chess.Board
+                :arg tpm:       Time per move
+                :type tpm:      int
+                :arg ply:       Depth of the search
+                :type ply:      int
+            Returns:
+                :return search: Search to pass to finish_search
+                :rtype search:  tuple
+        """
+        key = (board._transposition_key(), self.multi_pv, tpm, ply)
+        # Shelve keys have to be strings
+        disk_key = repr(key)
+        entry = None
+        analysis = None
+        if key in self.tt:
+            # Move it to the end as the most recently used
+            entry = self.tt.pop(key)
+        elif self.disk_tt is not None and disk_key in self.disk_tt:
+            entry = self.disk_tt[disk_key]
+        else:
+            analysis = self.engine.analysis(board, _search_limit(tpm, ply),
+                                            multipv=self.multi_pv)
+        return key, disk_key, entry, analysis
+
+    def finish_search(self, search):
+        """Wait for a search started with start_search.
+
+            Args:
+                :arg search:    Search returned by start_search
+                :type search:   tuple
+            Returns:
+                :return pv:     Principal variations by MultiPV position
+                :rtype pv:      dict{int: list[chess.Move]}
+                :return score:  Scores by MultiPV position
+                :rtype score:   dict{int: Score}
+        """
+        key, disk_key, entry, analysis = search
+        if analysis is not None:
+            analysis.wait()
+            pv = {}
+            score = {}
+            for multipv, info in enumerate(analysis.multipv, 1):
+                if 'pv' in info and 'score' in info:
+                    relative = info['score'].relative
+                    pv[multipv] = info['pv']
+                    score[multipv] = Score(relative.score(), relative.mate())
+            entry = (pv, score)
+            self.new_entries[disk_key] = entry
+        if key not in self.tt and len(self.tt) >= TT_SIZE:
+            self.tt.popitem(last=False)
+        self.tt[key] = entry
+        return entry
+
     def quit(self):
-        """Quit the engine."""
+        """Quit the engine and close the transposition table."""
         self.engine.quit()
+        if self.disk_tt is not None:
+            self.disk_tt.close()
+
+
+def save_disk_tt(tt_file, entries):
+    """Add searches to the transposition table stored in disk.
+
+        Args:
+            :arg tt_file:   File of the transposition table (Engine.tt_file)
+            :type tt_file:  str
+            :arg entries:   Searches by shelve key
+            :type entries:  dict
+    """
+    if entries:
+        with shelve.open(tt_file,
+                         protocol=pickle.HIGHEST_PROTOCOL) as disk_tt:
+            disk_tt.update(entries)
+            logger.debug('Transposition table %s: %d positions',
+                         tt_file, len(disk_tt))
+
+
+@functools.lru_cache(maxsize=None)
+def _search_limit(tpm, ply):
+    """Limit of the searches, the same for all the positions of a run.
+
+        Args:
+            :arg tpm:       Time per move in milliseconds
+            :type tpm:      int
+            :arg ply:       Depth of the search
+            :type ply:      int
+        Returns:
+            :return limit:  Limit for chess.engine
+            :rtype limit:   chess.engine.Limit
+    """
+    return chess.engine.Limit(time=tpm / 1000.0 if tpm is not None else None,
+                              depth=ply)
 
 
 class Game(chess.pgn.Game):
-    """Extend the chess.pgn.Game class to include statistics."""
+    """Extend the chess.pgn.Game class to include statistics.
+
+        :var self.moves_soa: Moves analyzed of each side, one array for each
+                             field of the moves instead of Move objects:
+                             SAN of the move and of the best move, cp of the
+                             difference, cp or mate of the best move and
+                             position of the move in the MultiPV lines
+        :type self.moves_soa: dict{str: dict{str: list | array.array}}
+    """
 
     def __init__(self, chess_pgn_game):
         """Extend init from chess.pgn.Game class."""
@@ -273,37 +440,93 @@ class Game(chess.pgn.Game):
         if chess_pgn_game is not None:
             self.headers = chess_pgn_game.headers
             self.variations = chess_pgn_game.variations
-        self.analyzed_game = {}
+        self.moves_soa = {}
+        for side in COLOURS:
+            self.moves_soa[side] = {'san': [],
+                                    'bm': [],
+                                    'cp_diff_cp': array.array('i'),
+                                    'bm_cp': array.array('i'),
+                                    'is_mate': array.array('b'),
+                                    'bmp': array.array('b')}
         self.number_plys = {}
         self.pos_dict = {}
         self.avg_diff = {}
         self.avg_cp = {}
         self.pv_dict = {}
+        self.cp_arr = {}
+        self.diff_arr = {}
+        self.pos_arr = {}
+        self._avg_cache = None
 
-    def store_analyzed_game(self, white_moves, black_moves):
-        """Store an analyzed game.
+    def add_move(self, side, move):
+        """Store a move analyzed in the arrays of its side.
 
-            An analyzed game is a dictionary with 2 keys: 'white' and 'black'
-            The values are lists with Move elements.
-            Initialize statistical variables.
             Args:
-                :arg white_moves:   White moves analyzed
-                :type white_moves:  list[Move]
-                :arg black_moves:   Black moves analyzed
-                :type black_moves:  list[Move]
+                :arg side:  Colour that did the move
+                :type side: str
+                :arg move:  Move analyzed
+                :type move: Move
+        """
+        moves = self.moves_soa[side]
+        moves['san'].append(move.move)
+        moves['bm'].append(move.bm)
+        moves['cp_diff_cp'].append(move.cp_diff.cp)
+        if move.bm_score.cp is not None:
+            moves['bm_cp'].append(move.bm_score.cp)
+            moves['is_mate'].append(0)
+        else:
+            moves['bm_cp'].append(move.bm_score.mate)
+            moves['is_mate'].append(1)
+        moves['bmp'].append(move.best_move_position)
 
+    def get_move(self, side, index):
+        """Move of a side built from the arrays, to print it.
+
+            Args:
+                :arg side:  Colour that did the move
+                :type side: str
+                :arg index: Number of the move of the side, from 0
+                :type index: int
             Returns:
+                :return move: Move stored (without the cp of the move)
+                :rtype move:  Move
+        """
+        moves = self.moves_soa[side]
+        if moves['is_mate'][index]:
+            bm_score = Score(None, moves['bm_cp'][index])
+        else:
+            bm_score = Score(moves['bm_cp'][index], None)
+        return Move(move=moves['san'][index],
+                    cp=None,
+                    bm=moves['bm'][index],
+                    bm_score=bm_score,
+                    bmp=moves['bmp'][index],
+                    cp_diff=Score(moves['cp_diff_cp'][index], None))
+
+    def store_analyzed_game(self):
+        """Store an analyzed game.
+
+            The moves are already stored with add_move.
+            Initialize statistical variables.
         """
-        self.analyzed_game = {'White': white_moves,
-                              'Black': black_moves}
-        self.number_plys = {'White': len(self.analyzed_game['White']),
-                            'Black': len(self.analyzed_game['Black'])}
+        self.number_plys = {'White': len(self.moves_soa['White']['san']),
+                            'Black': len(self.moves_soa['Black']['san'])}
         self.pos_dict = {'White': {},
                          'Black': {}}
         self.avg_diff = {'White': 0.0,
                          'Black': 0.0}
         self.avg_cp = {'White': 0.0,
                        'Black': 0.0}
+        self._avg_cache = None
+        # Scores of the best moves, differences and positions as arrays
+        for side in COLOURS:
+            moves = self.moves_soa[side]
+            is_mate = np.array(moves['is_mate'], dtype=bool)
+            self.cp_arr[side] =\
+                np.array(moves['bm_cp'], dtype=np.float64)[~is_mate] / 100.0
+            self.diff_arr[side] =\
+                np.array(moves['cp_diff_cp'], dtype=np.float64) / 100.0
+            self.pos_arr[side] = np.array(moves['bmp'], dtype=np.int32)
 
     def average_analyzed_game(self):
         """Calculate the averate for player's game.
@@ -317,35 +540,20 @@ class Game(chess.pgn.Game):
                                   move was in that position of the best move
                 :rtype pos_list:  dict{}
         """
+        if self._avg_cache is not None:
+            return self._avg_cache
         for side in COLOURS:
-            move_cp = []
-            cp_diff = []
-            pos_dict = {}
-            for move in self.analyzed_game[side]:
-                if not isinstance(move, Move):
-                    continue
-                if move.move is not None:
-                    cp_diff.append(move.cp_diff.cp / 100.0)
-                    # score_value = parse_score(move.cp)
-                    score_value = parse_score(move.bm_score)
-                    if score_value[0] != 'M':
-                        move_cp.append(float(score_value))
-                    if move.best_move_position != 0:
-                        if move.best_move_position not in pos_dict.keys():
-                            pos_dict[move.best_move_position] = 1
-                        else:
-                            pos_dict[move.best_move_position] += 1
-            total_moves = float(len(cp_diff))
-            if total_moves != 0:
-                self.pos_dict[side] = pos_dict
-                self.avg_diff[side] = sum(cp_diff) / total_moves
-                self.avg_cp[side] = sum(move_cp) / total_moves
-            else:
-                self.pos_dict[side] = pos_dict
-                self.avg_diff[side] = 0
-                self.avg_cp[side] = 0
-
-        return self.avg_cp, self.avg_diff, self.pos_dict
+            self.avg_diff[side], self.avg_cp[side], pos_count =\
+                _avg_side(self.diff_arr[side],
+                          self.cp_arr[side],
+                          self.pos_arr[side],
+                          max(POSITIONS) + 1)
+            self.pos_dict[side] = dict((pos, int(count))
+                                       for pos, count in enumerate(pos_count)
+                                       if pos != 0 and count != 0)
+        self._avg_cache = self.avg_cp, self.avg_diff, self.pos_dict
+
+        return self._avg_cache
 
     def analyze_pv_frecuency(self, pv_dict, total_moves):
         """Get % of matches between the engine and the player.
@@ -365,14 +573,13 @@ class Game(chess.pgn.Game):
         top_3_sum = 0
         top_3_percentaje = 0.0
         self.pv_dict = pv_dict
-        for i, _ in pv_dict.iteritems():
-            percentage = self.pv_dict[i] / float(total_moves) * 100
-            result_str += '  {}:   {:3} ({:5.2f}%)\n'.\
-                format(order[i - 1], self.pv_dict[i], percentage)
+        for i, _ in pv_dict.items():
+            percentage = self.pv_dict[i] / total_moves * 100
+            result_str += (f'  {order[i - 1]}:   {self.pv_dict[i]:3} '
+                           f'({percentage:5.2f}%)\n')
             top_3_sum += self.pv_dict[i]
-        top_3_percentaje = top_3_sum / float(total_moves) * 100
-        result_str += '  Top 3: {:3} ({:5.2f}%)\n'.\
-                      format(top_3_sum, top_3_percentaje)
+        top_3_percentaje = top_3_sum / total_moves * 100
+        result_str += f'  Top 3: {top_3_sum:3} ({top_3_percentaje:5.2f}%)\n'
 
         return result_str
 
@@ -380,7 +587,7 @@ class Game(chess.pgn.Game):
         """Print the analyzed game.
 
             Args:
-                Takes the analyzed_game from the Game
+                Takes the moves_soa from the Game
             Returns:
                 Printout with verbose or debug:
                 <mv #>. <mv> {white comment} - <mv> {black comment}
@@ -392,24 +599,21 @@ class Game(chess.pgn.Game):
                 :type game_str:     str
         """
         game_str = ''
-        for i in range(len(self.analyzed_game['White'])):
+        for i in range(self.number_plys['White']):
             # Move number. white - black
-            white_move = self.analyzed_game['White'][i]
-            if i > len(self.analyzed_game['Black']) - 1:
+            white_move = self.get_move('White', i)
+            if i > self.number_plys['Black'] - 1:
                 black_move = ''
             else:
-                black_move = self.analyzed_game['Black'][i]
-            game_str += '{:3}. {} - {}\n'.\
-                format(i + 1,
-                       white_move,
-                       black_move)
+                black_move = self.get_move('Black', i)
+            game_str += f'{i + 1:3}. {white_move} - {black_move}\n'
         return game_str
 
     def print_stats_game(self):
         """Print the stats of the game.
 
             Args:
-                Takes the analyzed_game from the Game
+                Takes the moves_soa from the Game
             Returns:
                 White: avg cp <avg_cp> avg diff <avg_diff> <pos_dict>
                 Black: avg cp <avg_cp> avg diff <avg_diff> <pos_dict>
@@ -417,70 +621,131 @@ class Game(chess.pgn.Game):
                 :type game_str:     str
         """
         game_str = ''
+        self.average_analyzed_game()
         for side in COLOURS:
-            _, _, _ = self.average_analyzed_game()
-            game_str += ('{:s}({:s}): avg cp {:+5.2f} avg diff {:+5.2f}\n'.
-                         format(side.capitalize(),
-                                self.headers[side.capitalize()],
-                                self.avg_cp[side],
-                                self.avg_diff[side]))
+            colour = side.capitalize()
+            game_str += (f'{colour:s}({self.headers[colour]:s}): '
+                         f'avg cp {self.avg_cp[side]:+5.2f} '
+                         f'avg diff {self.avg_diff[side]:+5.2f}\n')
             game_str += self.analyze_pv_frecuency(
                 self.pos_dict[side],
-                len(self.analyzed_game[side]))
+                self.number_plys[side])
         return game_str
 
 
-def read_all_pgn(filename):
-    """Read all the games of a PGN file.
+@njit(cache=True)
+def _avg_side(cp_diffs, bm_cps, positions, minlength):
+    """Averages of the moves of one side of a game.
+
+        Compiled with numba when it is installed.
+        Args:
+            :arg cp_diffs:  Differences with the best moves
+            :type cp_diffs: numpy.ndarray[float64]
+            :arg bm_cps:    Scores in pawns of the best moves, without mates
+            :type bm_cps:   numpy.ndarray[float64]
+            :arg positions: Position of the moves in the MultiPV lines
+            :type positions: numpy.ndarray[int32]
+            :arg minlength: Minimum length of the positions count
+            :type minlength: int
+        Returns:
+            :return avg_diff:  Average difference with the best move
+            :rtype avg_diff:   float
+            :return avg_cp:    Average score of the best move
+            :rtype avg_cp:     float
+            :return pos_count: Number of moves in each position
+            :rtype pos_count:  numpy.ndarray[int]
+    """
+    total_moves = len(cp_diffs)
+    pos_count = np.bincount(positions, minlength=minlength)
+    if total_moves == 0:
+        return 0.0, 0.0, pos_count
+    return (cp_diffs.sum() / total_moves,
+            bm_cps.sum() / total_moves,
+            pos_count)
+
+
+def scan_pgn(filename):
+    """Read the headers of all the games of a PGN file, without the moves.
 
         Args:
             :arg filename: Name of the PGN file
             :type filename: str
-        Returns:
-            :return all_games: List with all the games
-            :rtype: list[chess.game]
+        Yields:
+            :return offset:  Offset of the game in the file
+            :rtype offset:   int
+            :return headers: Headers of the game
+            :rtype headers:  chess.pgn.Headers
     """
     logger.info(' Reading PGN file {} '.format(filename).
                 center(80, '*'))
-    all_games = []
-    game_ok = True
+    number_of_games = 0
     time_0 = time.time()
-    with open(filename, 'r') as pgn_file:
-        while game_ok:
-            new_game = chess.pgn.read_game(pgn_file)
-            if new_game:
-                all_games.append(new_game)
-            else:
-                game_ok = False
+    with open(filename, 'r', encoding=PGN_ENCODING,
+              errors='replace') as pgn_file:
+        offset = pgn_file.tell()
+        headers = chess.pgn.read_headers(pgn_file)
+        while headers is not None:
+            number_of_games += 1
+            yield offset, headers
+            offset = pgn_file.tell()
+            headers = chess.pgn.read_headers(pgn_file)
     time_1 = time.time()
-    logger.info('Total number of games: %d', len(all_games))
+    logger.info('Total number of games: %d', number_of_games)
     logger.info('Time: %.2f seconds', (time_1 - time_0))
     logger.info(40 * '-')
 
-    return all_games
+
+def iter_pgn(filename, offsets):
+    """Read some games of a PGN file one by one.
+
+        Args:
+            :arg filename: Name of the PGN file
+            :type filename: str
+            :arg offsets:  Offsets of the games to read (see scan_pgn)
+            :type offsets: list[int]
+        Yields:
+            :return game:  Game read from the file
+            :rtype game:   chess.pgn.Game
+    """
+    with open(filename, 'r', encoding=PGN_ENCODING,
+              errors='replace') as pgn_file:
+        for offset in offsets:
+            pgn_file.seek(offset)
+            yield chess.pgn.read_game(pgn_file)
 
 
-def find_player(pgn_games, name):
+def find_player(pgn_headers, name):
     """Find a player in a pgn file using regular expressions.
 
         Args:
-            pgn_games   (list[chess.pgn.Game]) list of pgn games to parse
+            pgn_headers (iter[(int, chess.pgn.Headers)]) offsets and headers
+                        of the games to parse (see scan_pgn)
             name        (str) Name or part of the name of the player
         Returns:
             If there are several matches, the list of coincidences
-            If there is only one match, the name and the list of matches
+            If there is only one match, the name and the offsets of the
+            matching games
     """
+    if REGEX_CHARS.isdisjoint(name):
+        # Plain name: a substring search is much faster than a regex
+        name_lower = name.lower()
+
+        def match(value):
+            """Case insensitive substring search."""
+            return name_lower in value.lower()
+    else:
+        match = re.compile(name, flags=re.IGNORECASE).search
+    all_found = set()
+    offsets = []
+    for offset, headers in pgn_headers:
+        if match(headers['White']):
+            all_found.add(headers['White'])
+            offsets.append(offset)
+        if match(headers['Black']):
+            all_found.add(headers['Black'])
+            offsets.append(offset)
     logger.info('Searching for players matching: "%s"', name)
-    all_found = []
-    all_games = []
-    for game in pgn_games:
-        if re.search(name, game.headers['White'], flags=re.IGNORECASE):
-            all_found.append(game.headers['White'])
-            all_games.append(game)
-        if re.search(name, game.headers['Black'], flags=re.IGNORECASE):
-            all_found.append(game.headers['Black'])
-            all_games.append(game)
-    unique_players = list(set(all_found))
+    unique_players = list(all_found)
     if len(unique_players) > 1:
         logger.info('Several players found:')
         for name in unique_players:
@@ -493,7 +758,7 @@ def find_player(pgn_games, name):
         logger.info('No player found.')
     logger.info(40 * '-')
 
-    return unique_players, all_games
+    return unique_players, offsets
 
 
 def parse_score(score):
@@ -501,13 +766,13 @@ def parse_score(score):
 
         Args:
             :arg score:     Score to parse
-            :type score:    chess.uci.Score
+            :type score:    Score
         Returns:
             :return rscore: Score value
             :rtype rscore:  str with cp or number of move to mate
     """
     rscore = '0.0'
-    if isinstance(score, chess.uci.Score):
+    if isinstance(score, Score):
         if score.cp is not None:
             rscore = str(score.cp / 100.0)
         elif score.mate is not None:
@@ -541,66 +806,111 @@ def analyze_game(game, machine, ply=None, tpm=None, player=None):
             :rtype analyzed_game:   Game
     """
     analyzed_game = Game(game)
-    white_moves = []
-    black_moves = []
+    white_name = game.headers['White']
+    black_name = game.headers['Black']
+    debug = logger.isEnabledFor(logging.DEBUG)
     # Board
-    board = chess.Board()
-    stats = chess.uci.InfoHandler()
-    # Engine
-    machine.engine.ucinewgame()
-    machine.engine.info_handlers.append(stats)
+    board = game.board()
     # Analyze moves
     node = game
-    cp_score = chess.uci.Score(0, None)
+    cp_score = Score(0, None)
+
+    if not node.is_end():
+        search = machine.start_search(board, tpm=tpm, ply=ply)
 
     while not node.is_end():
         # Analyze current move
-        machine.engine.position(board)
-        machine.engine.go(movetime=tpm, depth=ply)
-        # Info
-        best_moves = {}
-        for k, v in stats.info['pv'].iteritems():
-            best_moves[k] = board.variation_san([v[0]]).split('.')[-1].strip()
-            logger.debug('Pos {:d}: {:12} {:5} {:5}'.
-                         format(k,
-                                board.variation_san([v[0]]),
-                                stats.info['score'][k].cp,
-                                stats.info['score'][k].mate))
-        # Push next move to the board
+        pv, score = machine.finish_search(search)
         node = node.variation(0)
-        if len(stats.info['pv']) == 0:
-            logger.warning('No data for: {} - {}: {}'.
-                           format(game.headers['White'],
-                                  game.headers['Black'],
-                                  node.san()))
+        # The engine searches the next position while this one is processed
+        board.push(node.move)
+        if not node.is_end():
+            search = machine.start_search(board, tpm=tpm, ply=ply)
+        board.pop()
+        # node.san() would rebuild the board from the root of the game
+        san = board.san(node.move)
+        # Info
+        best_moves = {k: board.san(v[0]) for k, v in pv.items()}
+        pos_by_san = {v: k for k, v in best_moves.items()}
+        if debug:
+            for k, v in best_moves.items():
+                logger.debug('Pos %d: %-12s %-5s %-5s',
+                             k, v, score[k].cp, score[k].mate)
+        if not pv:
+            logger.warning('No data for: %s - %s: %s',
+                           white_name, black_name, san)
+            board.push(node.move)
             continue
-        new_move = Move(move=node.san(),
+        new_move = Move(move=san,
                         cp=cp_score,
-                        bm=board.variation_san(
-                            [stats.info['pv'][1][0]]).split('.')[-1],
-                        bm_score=stats.info['score'][1])
-        if new_move.move in best_moves.values():
-            new_move.best_move_position =\
-                best_moves.keys()[best_moves.values().index(new_move.move)]
+                        bm=best_moves[1],
+                        bm_score=score[1])
+        new_move.best_move_position = pos_by_san.get(new_move.move, 0)
         cp_score = new_move.bm_score
-        logger.debug('bm: {:4s} cp={:7s} mv: {:4s} cp={:7s} pos={:<3d}'.
-                     format(new_move.bm,
-                            parse_score(new_move.bm_score),
-                            new_move.move,
-                            parse_score(new_move.cp),
-                            new_move.best_move_position))
-        board = node.board()
+        if debug:
+            logger.debug('bm: %-4s cp=%-7s mv: %-4s cp=%-7s pos=%-3d',
+                         new_move.bm,
+                         parse_score(new_move.bm_score),
+                         new_move.move,
+                         parse_score(new_move.cp),
+                         new_move.best_move_position)
+        board.push(node.move)
         if not board.turn:
-            white_moves.append(new_move)
+            analyzed_game.add_move('White', new_move)
         else:
-            black_moves.append(new_move)
-        logger.debug('Next move done: {:5}\n'.format(node.san()) + 40 * '-')
+            analyzed_game.add_move('Black', new_move)
+        logger.debug('Next move done: %-5s\n%s', san, 40 * '-')
 
-    analyzed_game.store_analyzed_game(white_moves, black_moves)
+    analyzed_game.store_analyzed_game()
 
     return analyzed_game
 
 
+def _init_worker(engine_path, persistent_tt, threads, hash_mb):
+    """Start the engine of a process of the pool.
+
+        Args:
+            :arg engine_path:   Path to the engine executable
+            :type engine_path:  str
+            :arg persistent_tt: Read the transposition table stored in disk,
+                                the new searches are saved by the main process
+            :type persistent_tt: bool
+            :arg threads:       Search threads of the engine
+            :type threads:      int
+            :arg hash_mb:       Size in MB of the hash of the engine
+            :type hash_mb:      int
+    """
+    global _WORKER_ENGINE
+    _WORKER_ENGINE = Engine(engine_path, persistent_tt=persistent_tt,
+                            threads=threads, hash_mb=hash_mb)
+    _WORKER_ENGINE.set_multi_pv(3)
+    # The pool does not run the atexit functions of its processes
+    multiprocessing.util.Finalize(_WORKER_ENGINE, _WORKER_ENGINE.quit,
+                                  exitpriority=10)
+
+
+def _analyze_one(args):
+    """Analyze a game in a process of the pool.
+
+        Args:
+            :arg args:      PGN of the game and time per move
+            :type args:     tuple(str, int)
+        Returns:
+            :return analyzed_game:  Game with the analysis
+            :rtype analyzed_game:   Game
+            :return new_entries:    Searches to add to the transposition table
+            :rtype new_entries:     dict
+    """
+    pgn_text, tpm = args
+    game = chess.pgn.read_game(io.StringIO(pgn_text))
+    analyzed_game = analyze_game(game, _WORKER_ENGINE, tpm=tpm)
+    # The moves are already in moves_soa, do not send them back
+    analyzed_game.variations = []
+    new_entries = _WORKER_ENGINE.new_entries
+    _WORKER_ENGINE.new_entries = {}
+    return analyzed_game, new_entries
+
+
 # ------------------------------------------------------------------------------
 #  /\  _ _     _ _  _  _ _|_ _   _  _  _|   _ _  _ . _
 # /~~\| (_||_|| | |(/_| | | _\  (_|| |(_|  | | |(_||| |
@@ -644,6 +954,28 @@ def arguments():
                         default=1000,
                         help='Time per move for the engine. '
                              'Default: 1000 micro-seconds')
+    parser.add_argument('--no-tt',
+                        action='store_true',
+                        help='Do not load nor save the transposition table '
+                             'in disk')
+    parser.add_argument('-j', '--jobs',
+                        action='store',
+                        type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of games analyzed at the same time, '
+                             'one engine for each one. '
+                             'Default: number of CPUs')
+    parser.add_argument('--threads',
+                        action='store',
+                        type=int,
+                        help='Search threads of each engine. '
+                             'Default: number of CPUs / jobs')
+    parser.add_argument('--hash-mb',
+                        action='store',
+                        type=int,
+                        default=512,
+                        help='Total hash size in MB, shared by the engines. '
+                             'Default: 512')
     args = parser.parse_args()
 
     return args
@@ -683,52 +1015,82 @@ def main():
     """"Steps.
 
         1. Arguments and logging
-        2. Read all teh games
+        2. Read the headers of all the games
         3. Find player and his/her games
-        4. Create chess engine
+        4. Identify chess engine
         5. Analysis begin
         6. Statistics
-        7. Quit engine
+        7. Save the transposition table
     """
     # 1. Arguments and logging
     args = arguments()
     logging_init(args.verbose, args.debug)
 
-    # 2. Read all the games
-    all_games = read_all_pgn(args.pgn_file)
+    # 2. Read the headers of all the games
+    pgn_headers = scan_pgn(args.pgn_file)
 
     # 3. Find player and his/her games
     if args.player is not None:
-        player_name, games_to_analyze = find_player(all_games, args.player)
+        player_name, offsets = find_player(pgn_headers, args.player)
     else:
         player_name = NONAME
-        games_to_analyze = all_games
+        offsets = [offset for offset, _ in pgn_headers]
     player = Player(player_name)
 
-    # 4. Create chess engine
-    chess_engine = Engine(args.engine)
-    chess_engine.set_multi_pv(3)
-
-    # 5. Analysis begin
-    game_number = 1
-    t0 = time.time()
-    for game in games_to_analyze:
-        # logger.info('Analyzing game {} of {}'.
-        print('Analyzing game {} of {}\r'.
-              format(game_number, len(games_to_analyze))),
-        game_extended = analyze_game(game, chess_engine, tpm=args.time)
-        logger.debug('{:s}'.format(game_extended.print_analyzed_game()))
-        player.insert_game(game_extended)
-        game_number += 1
-    t1 = time.time()
-    logger.info('\nTime: {:.2f} seconds'.format(t1 - t0))
-    logger.info(40 * '-')
+    # 4. Identify chess engine, the transposition table is named after it.
+    # The engines of the pool only read it, the new searches are saved here
+    # once the analysis is done.
+    chess_engine = Engine(args.engine, persistent_tt=False)
+    tt_file = None if args.no_tt else chess_engine.tt_file
+    chess_engine.quit()
+    new_tt = {}
 
-    # 6. Statistics
-    logger.info(player.print_stats())
+    try:
+        # 5. Analysis begin
+        game_number = 1
+        t0 = time.time()
+        # The cores and the hash are shared among the engines of the pool
+        threads = args.threads or max(1,
+                                      multiprocessing.cpu_count() // args.jobs)
+        hash_mb = max(1, args.hash_mb // args.jobs)
+        pool = multiprocessing.Pool(processes=args.jobs,
+                                    initializer=_init_worker,
+                                    initargs=(args.engine, not args.no_tt,
+                                              threads, hash_mb))
+        # The games are read while they are analyzed
+        games_pgn = ((str(game), args.time)
+                     for game in iter_pgn(args.pgn_file, offsets))
+        try:
+            for game_extended, new_entries in pool.imap_unordered(
+                    _analyze_one, games_pgn):
+                # logger.info('Analyzing game {} of {}'.
+                print(f'Analyzing game {game_number} of {len(offsets)}\r',
+                      end='', flush=True)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('%s', game_extended.print_analyzed_game())
+                if tt_file is not None:
+                    new_tt.update(new_entries)
+                player.insert_game(game_extended)
+                game_number += 1
+        except BaseException:
+            # The workers keep the transposition table open for reading, stop
+            # them before it is saved (dbm.gnu locks it for the readers)
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        t1 = time.time()
+        logger.info('\nTime: {:.2f} seconds'.format(t1 - t0))
+        logger.info(40 * '-')
 
-    # 7. Quit engine
-    chess_engine.quit()
+        # 6. Statistics
+        logger.info(player.print_stats())
+    finally:
+        # 7. Save the transposition table, also on errors
+        if tt_file is not None:
+            save_disk_tt(tt_file, new_tt)
 
 
 ###############################################################################
@@ -740,18 +1102,15 @@ def main():
 #
 ###############################################################################
 if __name__ == "__main__":
-    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
     # sys.tracebacklimit = 0
-    if sys.version_info < (2, 7):
-        print "Python 2.7 or higher required"
+    if sys.version_info < (3, 6):
+        print("Python 3.6 or higher required")
         sys.exit(9)
-    # General logger
-    logger = logging.getLogger(__name__)
 
     # Main funtion
     try:
         main()
     except KeyboardInterrupt:
-        print "\nProgram interrupted by CTRL-C.\n"
+        print("\nProgram interrupted by CTRL-C.\n")
         sys.exit()
 
@@ -1,17 +1,117 @@
-import json
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import gzip
 import urllib.request
 import os
-from urllib.error import HTTPError
+import shelve
+import threading
+import time
+from urllib.error import HTTPError, URLError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+# httpx is preferred over aiohttp only with its HTTP/2 support installed
+try:
+    import h2  # noqa: F401
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+# orjson parses the bytes of the answers directly and faster than json
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+class ChessComAPIError(Exception):
+    '''
+    Error querying the API of chess.com
+    '''
+    def __init__(self, url, status=None, body='', headers=None):
+        '''
+            :param url: URL queried
+            :type url: str
+            :param status: HTTP status of the answer, None if the server did
+                           not answer
+            :type status: int
+            :param body: Body of the answer, or why there was no answer
+            :type body: str
+            :param headers: Headers of the answer
+            :type headers: dict
+        '''
+        super().__init__(url, status, body)
+        self.url = url
+        self.status = status
+        self.body = body
+        # Seconds to wait before querying again, sent with 429 and 503
+        self.retry_after = None
+        if headers is not None and headers.get('Retry-After', '').isdigit():
+            self.retry_after = int(headers['Retry-After'])
+
+    def __str__(self):
+        return f'{self.url}: {self.status} {self.body}'
+
+
+def _run(coroutine):
+    '''
+        Run a coroutine until it is done in a new event loop, the faster
+        uvloop one if it is installed
+        :param coroutine: Coroutine to run
+        :type coroutine: coroutine
+        :return: Result of the coroutine
+    '''
+    if uvloop is None:
+        return asyncio.run(coroutine)
+    loop = uvloop.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
 
 
 class ChessCom(object):
     '''
     Class to wrap the API from chess.com website
     '''
+    __slots__ = ('user', '_url_profile', '_url_archives', '_url_current',
+                 '_url_to_move', '_session', '_cache', '_games', '_inflight',
+                 '_inflight_lock', '_ainflight')
     URL_ROOT = 'https://api.chess.com/pub/player/'
     ARCHIVES_PATH = 'games/archives'
     GAMES_PATH = 'games'
     GAMES_TO_MOVE_PATH = 'games/to-move'
+    TIMEOUT = 10
+    # requests, httpx and aiohttp ask for compressed answers by themselves
+    HEADERS = {'Accept-Encoding': 'gzip', 'User-Agent': 'chesscom-py/1.0'}
+    # Seconds to keep the answers in the cache
+    PROFILE_TTL = 3600
+    GAMES_TTL = 30
+    # Queries in flight at the same time, and retries after a 429 Too Many
+    # Requests waiting the Retry-After seconds or RATE_LIMIT_WAIT
+    MAX_CONCURRENT_QUERIES = 5
+    RATE_LIMIT_RETRIES = 2
+    RATE_LIMIT_WAIT = 60
+    # Games of the past months do not change, they are kept in disk
+    ARCHIVES_CACHE = os.path.join(os.path.expanduser('~'), '.cache',
+                                  'chesscom', 'archives')
     
     def __init__(self, user):
         '''
@@ -19,30 +119,342 @@ class ChessCom(object):
             :type user: str
         '''
         self.user = user
+        # The URLs only depend on the user
+        url_user = f'{self.URL_ROOT}{user}'
+        self._url_profile = url_user
+        self._url_archives = f'{url_user}/{self.ARCHIVES_PATH}'
+        self._url_current = f'{url_user}/{self.GAMES_PATH}'
+        self._url_to_move = f'{url_user}/{self.GAMES_TO_MOVE_PATH}'
+        # All the queries go to the same host, keep the connections alive
+        # between them when requests is installed
+        self._session = None
+        if requests is not None:
+            self._session = requests.Session()
+            self._session.headers['User-Agent'] = self.HEADERS['User-Agent']
+            self._session.mount('https://',
+                                HTTPAdapter(pool_connections=10,
+                                            pool_maxsize=20))
+        # URL: (expiration time, JSON data, ETag, Last-Modified), the headers
+        # revalidate the data once it expires
+        self._cache = {}
+        # (expiration time, current games, games to move), both lists are
+        # queried together so the methods always see the same snapshot
+        self._games = None
+        # URL: Future of the query in progress, the callers asking for the
+        # same URL at the same time wait for a single query
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._ainflight = {}
+
+    def close(self):
+        '''
+            Close the connections kept alive by the session
+        '''
+        if self._session is not None:
+            self._session.close()
 
     def _get_from_url(self, url):
         '''
-            Get JSON data from a URL
+            Get JSON data from a URL, joining the query in progress for the
+            same URL if there is one
             :param url: URL to query
             :type url: str
-            :return: JSON data from the query
-            :rtype: json (python dict)
+            :return: JSON data from the query, ETag and Last-Modified headers
+            :rtype: tuple
+        '''
+        with self._inflight_lock:
+            future = self._inflight.get(url)
+            query = future is None
+            if query:
+                future = concurrent.futures.Future()
+                self._inflight[url] = future
+        if query:
+            try:
+                future.set_result(self._query_url(url))
+            except Exception as ex:
+                future.set_exception(ex)
+            finally:
+                with self._inflight_lock:
+                    del self._inflight[url]
+        return future.result()
+
+    def _query_url(self, url):
         '''
+            Query a URL for JSON data. If the URL is in the cache, the query
+            is conditional and the cached data is used when it has not been
+            modified.
+            :param url: URL to query
+            :type url: str
+            :return: JSON data from the query, ETag and Last-Modified headers
+            :rtype: tuple
+        '''
+        headers = self._revalidation_headers(url)
+        if self._session is not None:
+            response = self._session_get(url, headers=headers)
+            if response.status_code == 304:
+                return self._cache[url][1:]
+            return (json_loads(response.content),
+                    response.headers.get('ETag'),
+                    response.headers.get('Last-Modified'))
         try:
-            with urllib.request.urlopen(url) as url_desc:
-                json_data = json.loads(url_desc.read().decode())
+            with self._urlopen(url, headers) as url_desc:
+                return (json_loads(self._decompress(url_desc).read()),
+                        url_desc.headers.get('ETag'),
+                        url_desc.headers.get('Last-Modified'))
+        except ChessComAPIError as ex:
+            # urllib raises the 304 Not Modified as an HTTPError
+            if ex.status == 304:
+                return self._cache[url][1:]
+            raise
+
+    def _session_get(self, url, **kwargs):
+        '''
+            Query a URL with the requests session
+            :param url: URL to query
+            :type url: str
+            :param kwargs: Arguments of requests.Session.get
+            :return: Answer of the server
+            :rtype: requests.Response
+            :raise ChessComAPIError: The server did not answer or answered
+                                     with an error
+        '''
+        try:
+            response = self._session.get(url, timeout=self.TIMEOUT, **kwargs)
+        except requests.RequestException as ex:
+            raise ChessComAPIError(url, body=str(ex)) from ex
+        if response.status_code >= 400:
+            raise ChessComAPIError(url, response.status_code, response.text,
+                                   response.headers)
+        return response
+
+    def _revalidation_headers(self, url):
+        '''
+            Headers to ask for the data of a URL only if it has changed since
+            it was cached
+            :param url: URL to query
+            :type url: str
+            :return: If-None-Match and If-Modified-Since headers, empty if the
+                     URL is not in the cache
+            :rtype: dict
+        '''
+        headers = {}
+        cached = self._cache.get(url)
+        if cached is not None:
+            if cached[2] is not None:
+                headers['If-None-Match'] = cached[2]
+            if cached[3] is not None:
+                headers['If-Modified-Since'] = cached[3]
+        return headers
+
+    def _urlopen(self, url, headers=None):
+        '''
+            Open a URL with urllib asking for a compressed answer
+            :param url: URL to open
+            :type url: str
+            :param headers: Headers to add to the request
+            :type headers: dict
+            :return: Answer of the server
+            :rtype: http.client.HTTPResponse
+            :raise ChessComAPIError: The server did not answer or answered
+                                     with an error or 304 Not Modified
+        '''
+        request = urllib.request.Request(url,
+                                         headers=dict(self.HEADERS,
+                                                      **(headers or {})))
+        try:
+            return urllib.request.urlopen(request, timeout=self.TIMEOUT)
         except HTTPError as ex:
-            print(ex.read())
+            body = self._decompress(ex).read().decode(errors='replace')
+            raise ChessComAPIError(url, ex.code, body, ex.headers) from ex
+        except URLError as ex:
+            raise ChessComAPIError(url, body=str(ex.reason)) from ex
+
+    @staticmethod
+    def _decompress(url_desc):
+        '''
+            Undo the gzip encoding of an answer opened with _urlopen
+            :param url_desc: Answer of the server
+            :type url_desc: http.client.HTTPResponse
+            :return: File object with the body of the answer
+            :rtype: file object
+        '''
+        if url_desc.headers.get('Content-Encoding') == 'gzip':
+            return gzip.GzipFile(fileobj=url_desc)
+        return url_desc
+
+    def _from_cache(self, url):
+        '''
+            Get the JSON data of a URL from the cache
+            :param url: URL queried
+            :type url: str
+            :return: JSON data, None if it is not cached or it has expired
+            :rtype: json (python dict)
+        '''
+        cached = self._cache.get(url)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        return None
+
+    def _cached_get(self, url, ttl):
+        '''
+            Get JSON data from the cache or, if it is not there, from a URL
+            :param url: URL to query
+            :type url: str
+            :param ttl: Seconds to keep the data in the cache
+            :type ttl: int
+            :return: JSON data from the query
+            :rtype: json (python dict)
+        '''
+        json_data = self._from_cache(url)
+        if json_data is None:
+            json_data, etag, last_modified = self._get_from_url(url)
+            self._cache[url] = (time.monotonic() + ttl, json_data, etag,
+                                last_modified)
+        return json_data
+
+    async def _aget_from_url(self, session, semaphore, url, ttl):
+        '''
+            Get JSON data from the cache or from a URL without blocking the
+            event loop
+            :param session: Session to query, None to run _get_from_url in a
+                            thread when httpx and aiohttp are not installed
+            :type session: httpx.AsyncClient or aiohttp.ClientSession
+            :param semaphore: Limit of the queries in flight
+            :type semaphore: asyncio.Semaphore
+            :param url: URL to query
+            :type url: str
+            :param ttl: Seconds to keep the data in the cache
+            :type ttl: int
+            :return: JSON data from the query
+            :rtype: json (python dict)
+        '''
+        json_data = self._from_cache(url)
+        if json_data is not None:
+            return json_data
+        task = self._ainflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(
+                self._aquery_url(session, semaphore, url, ttl))
+            self._ainflight[url] = task
+            task.add_done_callback(lambda _: self._ainflight.pop(url))
+        return await task
+
+    async def _aquery_url(self, session, semaphore, url, ttl):
+        '''
+            Query a URL for JSON data without blocking the event loop and
+            keep it in the cache. The query is repeated if the API answers
+            429 Too Many Requests.
+            :param session: Session to query, None to run _get_from_url in a
+                            thread when httpx and aiohttp are not installed
+            :type session: httpx.AsyncClient or aiohttp.ClientSession
+            :param semaphore: Limit of the queries in flight
+            :type semaphore: asyncio.Semaphore
+            :param url: URL to query
+            :type url: str
+            :param ttl: Seconds to keep the data in the cache
+            :type ttl: int
+            :return: JSON data from the query
+            :rtype: json (python dict)
+        '''
+        for retry in range(self.RATE_LIMIT_RETRIES + 1):
+            try:
+                async with semaphore:
+                    json_data, etag, last_modified = await self._aquery(
+                        session, url)
+                break
+            except ChessComAPIError as ex:
+                if ex.status != 429 or retry == self.RATE_LIMIT_RETRIES:
+                    raise
+                wait = ex.retry_after
+            await asyncio.sleep(self.RATE_LIMIT_WAIT if wait is None
+                                else wait)
+        self._cache[url] = (time.monotonic() + ttl, json_data, etag,
+                            last_modified)
         return json_data
 
+    async def _aquery(self, session, url):
+        '''
+            Query a URL for JSON data without blocking the event loop
+            :param session: Session to query, None to run _get_from_url in a
+                            thread when httpx and aiohttp are not installed
+            :type session: httpx.AsyncClient or aiohttp.ClientSession
+            :param url: URL to query
+            :type url: str
+            :return: JSON data from the query, ETag and Last-Modified headers
+            :rtype: tuple
+        '''
+        if session is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._get_from_url, url)
+        headers = self._revalidation_headers(url)
+        if httpx is not None:
+            try:
+                response = await session.get(url, headers=headers)
+            except httpx.HTTPError as ex:
+                raise ChessComAPIError(url, body=str(ex)) from ex
+            if response.status_code == 304:
+                return self._cache[url][1:]
+            if response.status_code >= 400:
+                raise ChessComAPIError(url, response.status_code,
+                                       response.text, response.headers)
+            return (json_loads(response.content),
+                    response.headers.get('ETag'),
+                    response.headers.get('Last-Modified'))
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    return self._cache[url][1:]
+                if response.status >= 400:
+                    raise ChessComAPIError(url, response.status,
+                                           await response.text(),
+                                           response.headers)
+                return (json_loads(await response.read()),
+                        response.headers.get('ETag'),
+                        response.headers.get('Last-Modified'))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            raise ChessComAPIError(url, body=str(ex)) from ex
+
+    async def _aget_all(self, queries):
+        '''
+            Query several URLs concurrently
+            :param queries: URLs to query with the seconds to cache them
+                            [(url, ttl), ...]
+            :type queries: list
+            :return: JSON data from the queries, in the order of the URLs
+            :rtype: list
+        '''
+        # Created here to belong to the running event loop
+        semaphore = asyncio.Semaphore(self.MAX_CONCURRENT_QUERIES)
+        headers = {'User-Agent': self.HEADERS['User-Agent']}
+        async with contextlib.AsyncExitStack() as stack:
+            session = None
+            if httpx is not None:
+                # HTTP/2 multiplexes all the queries in one connection
+                session = await stack.enter_async_context(
+                    httpx.AsyncClient(http2=True, headers=headers,
+                                      timeout=self.TIMEOUT))
+            elif aiohttp is not None:
+                session = await stack.enter_async_context(
+                    aiohttp.ClientSession(
+                        headers=headers,
+                        timeout=aiohttp.ClientTimeout(total=self.TIMEOUT)))
+            results = await asyncio.gather(
+                *[self._aget_from_url(session, semaphore, url, ttl)
+                  for url, ttl in queries], return_exceptions=True)
+        # Raise the first error once all the queries are done, so none of
+        # them is left running when the caller closes the event loop
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
     def _read_profile(self):
         '''
             Query for the profile
             :return: Profile of the user
             :rtype: JSON
         '''
-        url_profile = os.path.join(self.URL_ROOT, self.user)
-        return self._get_from_url(url_profile)
+        return self._cached_get(self._url_profile, self.PROFILE_TTL)
 
     def _read_archives(self):
         '''
@@ -50,10 +462,130 @@ class ChessCom(object):
             :return: List with the year/months archive of the user
             :rtype: JSON
         '''
-        url_archives = os.path.join(self.URL_ROOT,
-                                    self.user,
-                                    self.ARCHIVES_PATH)
-        return self._get_from_url(url_archives)
+        return self._cached_get(self._url_archives, self.PROFILE_TTL)
+
+    def read_archive(self, archive_url):
+        '''
+            Query for the games of a month of the archives. The months before
+            the current one are read from the disk cache when possible.
+            :param archive_url: URL of the month, one of the list of archives
+            :type archive_url: str
+            :return: List with the games of the month
+            :rtype: JSON
+        '''
+        if not self._past_month(archive_url):
+            return self._cached_get(archive_url, self.GAMES_TTL)
+        with self._open_archives_cache() as archives:
+            if archive_url not in archives:
+                archives[archive_url] = self._get_from_url(archive_url)[0]
+            return archives[archive_url]
+
+    def iter_archive_games(self, archive_url):
+        '''
+            Iterate over the games of a month of the archives. With ijson the
+            answer is parsed while it is downloaded, one game at a time,
+            instead of loading the whole month in memory. The months already
+            in the caches are read from there, the past months streamed to
+            the end are saved in the disk cache.
+            :param archive_url: URL of the month, one of the list of archives
+            :type archive_url: str
+            :return: Games of the month
+            :rtype: generator of JSON
+        '''
+        if ijson is None:
+            yield from self.read_archive(archive_url)['games']
+            return
+        past_month = self._past_month(archive_url)
+        json_data = self._from_cache(archive_url)
+        if json_data is None and past_month:
+            with self._open_archives_cache() as archives:
+                json_data = archives.get(archive_url)
+        if json_data is not None:
+            yield from json_data['games']
+        elif not past_month:
+            yield from self._stream_games(archive_url)
+        else:
+            # The games of a past month do not change, keep them for the
+            # next runs once the whole month is read
+            games = []
+            for game in self._stream_games(archive_url):
+                games.append(game)
+                yield game
+            with self._open_archives_cache() as archives:
+                archives[archive_url] = {'games': games}
+
+    def _stream_games(self, url):
+        '''
+            Parse the games of an answer while it is downloaded
+            :param url: URL to query, it returns a list of games
+            :type url: str
+            :return: Games of the answer
+            :rtype: generator of JSON
+        '''
+        if self._session is None:
+            with self._urlopen(url) as url_desc:
+                yield from ijson.items(self._decompress(url_desc),
+                                       'games.item', use_float=True)
+            return
+        with self._session_get(url, stream=True) as response:
+            # Let urllib3 undo the gzip encoding of the stream
+            response.raw.decode_content = True
+            yield from ijson.items(response.raw, 'games.item',
+                                   use_float=True)
+
+    @staticmethod
+    def _past_month(archive_url):
+        '''
+            Check if a month of the archives is over, so its games do not
+            change anymore
+            :param archive_url: URL of the month, ending in year/month
+            :type archive_url: str
+            :return: True if the month is before the current one
+            :rtype: bool
+        '''
+        year, month = archive_url.rstrip('/').split('/')[-2:]
+        today = datetime.datetime.now(datetime.timezone.utc)
+        return (int(year), int(month)) < (today.year, today.month)
+
+    def _open_archives_cache(self):
+        '''
+            Open the disk cache with the games of the past months
+            :return: Cache of the games by the URL of the month
+            :rtype: shelve.Shelf
+        '''
+        os.makedirs(os.path.dirname(self.ARCHIVES_CACHE), exist_ok=True)
+        return shelve.open(self.ARCHIVES_CACHE)
+
+    def _set_games(self, current_games, games_to_move):
+        '''
+            Keep the snapshot of the games of the user for GAMES_TTL seconds
+            :param current_games: List with the games currently active
+            :type current_games: JSON
+            :param games_to_move: List with games to move
+            :type games_to_move: JSON
+        '''
+        self._games = (time.monotonic() + self.GAMES_TTL, current_games,
+                       games_to_move)
+
+    def refresh_games(self):
+        '''
+            Query for the current games and the games to move if the snapshot
+            of both lists has expired
+        '''
+        if self._games is None or self._games[0] <= time.monotonic():
+            self._set_games(
+                self._cached_get(self._url_current, self.GAMES_TTL),
+                self._cached_get(self._url_to_move, self.GAMES_TTL))
+
+    async def refresh_games_async(self):
+        '''
+            Query at the same time for the current games and the games to
+            move if the snapshot of both lists has expired
+        '''
+        if self._games is None or self._games[0] <= time.monotonic():
+            self._set_games(*await self._aget_all(
+                [(self._url_current, self.GAMES_TTL),
+                 (self._url_to_move, self.GAMES_TTL)]))
 
     def read_current_games(self):
         '''
@@ -61,10 +593,8 @@ class ChessCom(object):
             :return: List with the games currently active
             :rtype: JSON
         '''
-        url_games = os.path.join(self.URL_ROOT,
-                                 self.user,
-                                 self.GAMES_PATH)
-        return self._get_from_url(url_games)
+        self.refresh_games()
+        return self._games[1]
 
     def read_games_to_move(self):
         '''
@@ -72,24 +602,74 @@ class ChessCom(object):
             :return: List with games to move
             :rtype: JSON
         '''
-        url_games = os.path.join(self.URL_ROOT,
-                                 self.user,
-                                 self.GAMES_TO_MOVE_PATH)
-        return self._get_from_url(url_games)
+        self.refresh_games()
+        return self._games[2]
 
-    def get_fen_to_move(self):
+    def current_fens(self):
+        '''
+            Get the FEN position of all the current games of the user
+            :return: List with the FEN of the games currently active
+            :rtype: list
+        '''
+        return [game['fen']
+                for game in self.read_current_games().get('games', ())]
+
+    async def refresh_all_async(self):
+        '''
+            Query at the same time for the profile, the archives, the current
+            games and the games to move of the user
+            :return: (profile, archives, current games, games to move)
+            :rtype: tuple
+        '''
+        state = tuple(await self._aget_all(
+            [(self._url_profile, self.PROFILE_TTL),
+             (self._url_archives, self.PROFILE_TTL),
+             (self._url_current, self.GAMES_TTL),
+             (self._url_to_move, self.GAMES_TTL)]))
+        self._set_games(*state[2:])
+        return state
+
+    def refresh_all(self):
+        '''
+            Blocking version of refresh_all_async, it can not be called from
+            a running event loop.
+            :return: (profile, archives, current games, games to move)
+            :rtype: tuple
+        '''
+        return _run(self.refresh_all_async())
+
+    async def get_fen_to_move_async(self):
         '''
             Join the games to move and the information of those games to be
-            able to return a list with the FEN position of the games.
+            able to return a list with the FEN position of the games. Both
+            lists of games are queried at the same time.
             :return: List with the FEN of the games to move
             :rtype: list
         '''
-        games_to_move = self.read_games_to_move()
-        current_games = self.read_current_games()
+        await self.refresh_games_async()
+        _, current_games, games_to_move = self._games
+        # The games to move only need the join if they come without FEN
+        if all('fen' in game for game in games_to_move['games']):
+            return [game['fen'] for game in games_to_move['games']]
+        # Index the current games by last activity to join in a single pass
+        fen_by_activity = {}
+        for game in current_games['games']:
+            fen_by_activity.setdefault(game['last_activity'],
+                                       []).append(game['fen'])
         fen_to_move = []
         for game_to_move in games_to_move['games']:
-            last_activity = game_to_move['last_activity']
-            for game in current_games['games']:
-                if game['last_activity'] == last_activity:
-                    fen_to_move.append(game['fen'])
+            if 'fen' in game_to_move:
+                fen_to_move.append(game_to_move['fen'])
+            else:
+                fen_to_move.extend(
+                    fen_by_activity.get(game_to_move['last_activity'], []))
         return fen_to_move
+
+    def get_fen_to_move(self):
+        '''
+            Blocking version of get_fen_to_move_async, it can not be called
+            from a running event loop.
+            :return: List with the FEN of the games to move
+            :rtype: list
+        '''
+        return _run(self.get_fen_to_move_async())